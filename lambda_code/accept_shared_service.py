@@ -3,15 +3,25 @@ import os
 import json
 import time
 import sys
+from functools import partial
 
 from pip._internal import main
 
 # ----- TEMPORAL: UPDATE BOTO3 TO HAVE VPC-LATTICE
-main(['install', '-I', '-q', 'boto3', '--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0,'/tmp/')
+# The reconciler imports both accept_shared_service and disassociate_unshared_service: only the first one installs boto3
+if '/tmp/' not in sys.path:
+    main(['install', '-I', '-q', 'boto3', '--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
+    sys.path.insert(0,'/tmp/')
 # -----
 import boto3
 
+from adaptive_schedule import Fingerprint, finish_run, load_schedule_state, should_skip_run
+from config import get_config, is_allowed_account, is_allowed_stage, publish_decision_counters
+from discovery import map_calls
+from log_summary import ItemSummary, dumps_capped, log_summary
+from topology_snapshot import resolve_network_stages, save_snapshot, verify_network_stage
+from tracing import correlation_from_tags, trace
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -19,17 +29,14 @@ ram_client = boto3.client('ram')
 vpc_lattice_client = boto3.client('vpc-lattice')
 ssm_client = boto3.client('ssm')
 
-allowlist_str = os.getenv('ALLOWED_ACCOUNTS') or ''
-allowlist = [a.strip() for a in allowlist_str.split(',')]
-allowlist_enabled = 'ALL' not in allowlist
-
 stage_to_network_parameter = os.getenv("PARAMETER_NAME")
-stage_names_env = os.getenv('STAGE_NAMES') or ''
-stage_names = [k.strip().lower() for k in stage_names_env.split(',')]
 stage_to_network_dict = {}
 
 my_account = os.getenv("MY_ACCOUNT")
 
+# Associations created by this container and not yet seen ACTIVE, so each one is traced as ACTIVE once
+pending_active_associations = set()
+
 def lambda_handler(event, context):
     """
     Performs 2 actions:
@@ -42,35 +49,67 @@ def lambda_handler(event, context):
     Note: if you manually delete a ServiceNetworkServiceAssociation without
     deleting the RAM share, this Lambda Function will recreate the association.
     """
-    logger.info(f'Received event {event} and context {context}')
+    logger.info(f'Received event {dumps_capped(event)} and context {context}')
+    # If nothing moved since the last run, the run is skipped
+    schedule_state = load_schedule_state()
+    fingerprint = get_fingerprint() if schedule_state is not None else None
+    if should_skip_run(schedule_state, fingerprint):
+        finish_run(schedule_state, fingerprint, 0, skipped=True)
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Nothing changed since the last run.')
+        }
+    # Loads (or refreshes) the allowlist and stages before the concurrent share processing
+    get_config()
     set_stage_to_network_dict()
-    invitations = get_all_pending_resource_share_invitations()
-    logger.info(f'Found invitations {invitations}')
-    
-    for invitation in invitations:
-        accept_pending_resource_share_invitation(invitation)
-    # We wait 5 seconds for avoid skipping recently accepted shared resources
-    time.sleep(5)
+    num_accepted = accept_pending_resource_share_invitations()
+    if num_accepted > 0:
+        # We wait 5 seconds for avoid skipping recently accepted shared resources
+        time.sleep(5)
     # Association of all accepted resources
-    associate_services_from_accepted_resource_shares()
+    num_created = associate_services_from_accepted_resource_shares()
+    publish_decision_counters()
+    finish_run(schedule_state, fingerprint, num_accepted + num_created)
     return {
         'statusCode': 200,
         'body': json.dumps('Successfully processed all pending invitations.')
     }
 
 
+def get_fingerprint():
+    """
+    Cheap digest of what a run depends on: pending invitations, accepted shares and
+    their update times, services shared with the Account (a service can be added to
+    or removed from a share without updating it), and service networks with their
+    update times and number of associated services.
+    """
+    fingerprint = Fingerprint()
+    for invitation in iter_pending_resource_share_invitations():
+        fingerprint.add(invitation['resourceShareInvitationArn'])
+    for page in iter_accepted_resource_share_pages():
+        for share in page:
+            fingerprint.add(share['resourceShareArn'], share.get('lastUpdatedTime'))
+    for service in iter_shared_services():
+        fingerprint.add(service['arn'], service.get('resourceShareArn'), service.get('lastUpdatedTime'))
+    for page in iter_service_network_pages():
+        for sn in page:
+            fingerprint.add(sn['arn'], sn.get('lastUpdatedAt'), sn.get('numberOfAssociatedServices'))
+    return fingerprint.hexdigest()
+
+
 def set_stage_to_network_dict():
     global stage_to_network_dict
     
-    all_service_networks = get_all_service_networks()
-    
-    for sn in all_service_networks:
-        sn_account = sn['arn'].split(':')[4]
-        if sn_account == my_account:
-            tags = vpc_lattice_client.list_tags_for_resource(resourceArn=sn['arn'])['tags']
-            if 'stage' in tags.keys():
-                if tags['stage'] in stage_names:
-                    stage_to_network_dict[tags['stage']] = sn['arn']
+    for page in iter_service_network_pages():
+        own_service_networks = [sn for sn in page if sn['arn'].split(':')[4] == my_account]
+        # Stages come from the warm-start snapshot, only new or updated service networks are looked up
+        stages = resolve_network_stages(own_service_networks, get_service_network_stage)
+        candidates = [sn for sn, stage in zip(own_service_networks, stages) if stage in get_config().stage_names]
+        # The stages of the candidates are checked again, the snapshot can miss a stage tag change
+        for sn, stage in zip(candidates, map_calls(partial(verify_network_stage, lookup_stage=get_service_network_stage), candidates)):
+            if stage in get_config().stage_names:
+                stage_to_network_dict[stage] = sn['arn']
+    save_snapshot()
     
     logger.info(f'Set stage to network dict {stage_to_network_dict}')
 
@@ -81,74 +120,116 @@ def set_stage_to_network_dict():
         Overwrite=True
     )
 
-def get_all_service_networks():
-    service_networks = []
+def get_service_network_stage(sn):
+    return vpc_lattice_client.list_tags_for_resource(resourceArn=sn['arn'])['tags'].get('stage')
+
+def iter_service_network_pages():
     paginator = vpc_lattice_client.get_paginator('list_service_networks')
     for page in paginator.paginate():
-        service_networks.extend(page['items'])
-    return service_networks
+        yield page['items']
+
+def iter_shared_services():
+    paginator = ram_client.get_paginator('list_resources')
+    for page in paginator.paginate(
+        resourceOwner='OTHER-ACCOUNTS',
+        resourceType='vpc-lattice:Service'
+    ):
+        yield from page['resources']
 
-def get_all_pending_resource_share_invitations():
-    invitations = []
+def iter_pending_resource_share_invitations():
     paginator = ram_client.get_paginator('get_resource_share_invitations')
     for page in paginator.paginate():
-        invitations.extend(page['resourceShareInvitations'])
-    return [inv for inv in invitations if inv['status'] == 'PENDING']
+        for inv in page['resourceShareInvitations']:
+            if inv['status'] == 'PENDING':
+                yield inv
+
+def iter_accepted_resource_share_pages():
+    paginator = ram_client.get_paginator('get_resource_shares')
+    for page in paginator.paginate(
+        resourceOwner='OTHER-ACCOUNTS',
+        resourceShareStatus='ACTIVE'
+    ):
+        yield page['resourceShares']
+
+def accept_pending_resource_share_invitations():
+    # Invitations are processed as they are listed, only a bounded summary is kept for the logs
+    invitations = ItemSummary('invitations', key=lambda inv: inv['resourceShareArn'])
+    num_accepted = 0
+    for invitation in invitations.track(iter_pending_resource_share_invitations()):
+        num_accepted += accept_pending_resource_share_invitation(invitation)
+    log_summary('Processed pending invitations', invitations, accepted=num_accepted)
+    return num_accepted
 
 def accept_pending_resource_share_invitation(invitation):
     share_name = invitation['resourceShareName']
     share_arn = invitation['resourceShareArn']
     share_sender_account = invitation['senderAccountId']
-    logger.info(f"Processing Resource Share Invitation {share_arn}, named {share_name}, from {share_sender_account}")
+    logger.debug(f"Processing Resource Share Invitation {share_arn}, named {share_name}, from {share_sender_account}")
     
-    if allowlist_enabled and share_sender_account not in allowlist:
-        logger.info(f'Share Invitation sender is not in allowlist. Ignoring Share Invitation {share_arn}.')
-        return
+    if not is_allowed_account(share_sender_account):
+        logger.debug(f'Share Invitation sender is not in allowlist. Ignoring Share Invitation {share_arn}.')
+        return False
     
-    if share_name not in stage_names:
-        logger.info(f'Share Invitation name does not match expected pattern, expected one of {stage_names}. Ignoring Share Invitation {share_arn}.')
-        return
+    if not is_allowed_stage(share_name):
+        logger.debug(f'Share Invitation name does not match expected pattern, expected one of {sorted(get_config().stage_names)}. Ignoring Share Invitation {share_arn}.')
+        return False
     
     logger.info(f'Accepting Resource Share Invitation {share_arn}.')
     accepted_share = ram_client.accept_resource_share_invitation(
         resourceShareInvitationArn=invitation['resourceShareInvitationArn']
     )
+    trace('invitation_accepted', stage=share_name, share=share_arn, sender=share_sender_account)
+    return True
 
 def associate_services_from_accepted_resource_shares():
-    shares = []
-    paginator = ram_client.get_paginator('get_resource_shares')
-    for page in paginator.paginate(
-        resourceOwner='OTHER-ACCOUNTS',
-        resourceShareStatus='ACTIVE'
-    ):
-        shares.extend(page['resourceShares'])
+    shares = ItemSummary('shares', key=lambda share: share['resourceShareArn'])
+    num_created = 0
+    # Shares are processed one page at a time, so only one page is held in memory
+    for page in iter_accepted_resource_share_pages():
+        # Each share lists its own resources (with retries) and associations, so they are processed concurrently
+        num_created += sum(map_calls(associate_services_from_accepted_resource_share, list(shares.track(page))))
 
-    logger.info(f'Found existing resource shares: {shares}')
-    for share in shares:
-        associate_services_from_accepted_resource_share(share)
+    log_summary('Processed existing resource shares', shares, created=num_created)
+    return num_created
 
 
-def associate_services_from_accepted_resource_share(share):
+def is_allowed_share(share):
     share_name = share['name']
     share_arn = share['resourceShareArn']
     share_sender_account = share['owningAccountId']
-    logger.info(f"Processing Accepted Resource Share {share_arn}, named {share_name}, from {share_sender_account}")
+    logger.debug(f"Processing Accepted Resource Share {share_arn}, named {share_name}, from {share_sender_account}")
     
-    if allowlist_enabled and share_sender_account not in allowlist:
-        logger.info(f'Share sender is not in allowlist. Ignoring Share {share_arn}.')
-        return
+    if not is_allowed_account(share_sender_account):
+        logger.debug(f'Share sender is not in allowlist. Ignoring Share {share_arn}.')
+        return False
     
-    if share_name not in stage_names:
-        logger.info(f'Share name does not match expected pattern, expected one of {stage_names}. Ignoring Share {share_arn}.')
-        return
+    if not is_allowed_stage(share_name):
+        logger.debug(f'Share name does not match expected pattern, expected one of {sorted(get_config().stage_names)}. Ignoring Share {share_arn}.')
+        return False
+    
+    return True
+
+
+def associate_services_from_accepted_resource_share(share):
+    if not is_allowed_share(share):
+        return 0
     
+    share_name = share['name']
+    share_arn = share['resourceShareArn']
     services = get_shared_services(share)
-    logger.info(f'Found services in resource share {services}')    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Found services in resource share {share_arn}: {dumps_capped([s["arn"] for s in services])}')
     
     service_network_arn = stage_to_network_dict[share_name]
+    correlation_id, origin = correlation_from_tags(share.get('tags'))
     
+    num_created = 0
     for service in services:
-        create_association_if_not_associated(service_network_arn, service['arn'], share_name)
+        num_created += create_association_if_not_associated(
+            service_network_arn, service['arn'], share_name,
+            share_arn, correlation_id, origin
+        )
+    return num_created
 
 
 def get_shared_services(resource_share):
@@ -168,15 +249,66 @@ def get_shared_services(resource_share):
 def create_association_if_not_associated(
     service_network_identifier,
     service_identifier,
-    share_name
+    share_name,
+    share_arn=None,
+    correlation_id=None,
+    origin=None
 ):
     existing_associations = vpc_lattice_client.list_service_network_service_associations(
         serviceNetworkIdentifier=service_network_identifier,
         serviceIdentifier=service_identifier
     )['items']
     if (len(existing_associations) == 0):
-        logger.info(f'Associating Service {service_identifier} to {share_name} Service Network {service_network_identifier}')
-        vpc_lattice_client.create_service_network_service_association(
-            serviceNetworkIdentifier=service_network_identifier,
-            serviceIdentifier=service_identifier
-        )
\ No newline at end of file
+        create_association(
+            service_network_identifier, service_identifier, share_name,
+            share_arn, correlation_id, origin
+        )
+        return 1
+    trace_active_associations(
+        existing_associations, service_network_identifier, service_identifier, share_name,
+        share_arn, correlation_id, origin
+    )
+    return 0
+
+
+def create_association(
+    service_network_identifier,
+    service_identifier,
+    share_name,
+    share_arn=None,
+    correlation_id=None,
+    origin=None
+):
+    logger.info(f'Associating Service {service_identifier} to {share_name} Service Network {service_network_identifier}')
+    association = vpc_lattice_client.create_service_network_service_association(
+        serviceNetworkIdentifier=service_network_identifier,
+        serviceIdentifier=service_identifier
+    )
+    pending_active_associations.add(association['arn'])
+    trace(
+        'service_association_created', correlation_id, origin, service_identifier, share_name,
+        share=share_arn,
+        serviceNetwork=service_network_identifier,
+        status=association.get('status')
+    )
+
+
+def trace_active_associations(
+    associations,
+    service_network_identifier,
+    service_identifier,
+    share_name,
+    share_arn=None,
+    correlation_id=None,
+    origin=None
+):
+    # The associations created by a previous run are ready: record them (only once)
+    for association in associations:
+        if association.get('status') == 'ACTIVE' and association.get('arn') in pending_active_associations:
+            pending_active_associations.discard(association['arn'])
+            trace(
+                'association_active', correlation_id, origin, service_identifier, share_name,
+                share=share_arn,
+                serviceNetwork=service_network_identifier,
+                status='ACTIVE'
+            )
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger()
+
+schedule_name = os.getenv('SCHEDULE_NAME')
+# SSM parameter keeping the state between runs. Without it, the schedule is not adapted
+schedule_state_parameter = os.getenv('SCHEDULE_STATE_PARAMETER')
+schedule_min_minutes = int(os.getenv('SCHEDULE_MIN_MINUTES') or 1)
+schedule_max_minutes = int(os.getenv('SCHEDULE_MAX_MINUTES') or 30)
+
+
+def aws_client(service):
+    # boto3 is imported here, so the scheduling logic can be tested without it
+    import boto3
+    return boto3.client(service)
+
+
+class Fingerprint:
+    """
+    Order-independent digest of a stream of items (e.g. share ARNs and update
+    times), computed without keeping the items in memory.
+    """
+    def __init__(self):
+        self.count = 0
+        self.digest = 0
+
+    def add(self, *parts):
+        item_hash = hashlib.sha256(json.dumps(parts, default=str).encode()).digest()
+        self.digest ^= int.from_bytes(item_hash[:16], 'big')
+        self.count += 1
+
+    def hexdigest(self):
+        return f'{self.count}-{self.digest:032x}'
+
+
+def rate_expression(minutes):
+    return f"rate({minutes} {'minute' if minutes == 1 else 'minutes'})"
+
+
+def next_interval_minutes(interval, changes):
+    """
+    Runs every `schedule_min_minutes` while the last run changed something, and
+    doubles the interval (up to `schedule_max_minutes`) while runs change nothing.
+    """
+    if changes > 0:
+        return schedule_min_minutes
+    return max(schedule_min_minutes, min(interval * 2, schedule_max_minutes))
+
+
+def load_schedule_state():
+    if not schedule_state_parameter:
+        return None
+    value = aws_client('ssm').get_parameter(Name=schedule_state_parameter)['Parameter']['Value']
+    try:
+        state = json.loads(value)
+    except ValueError:
+        state = {}
+    state.setdefault('intervalMinutes', schedule_min_minutes)
+    return state
+
+
+def should_skip_run(state, fingerprint):
+    """
+    A run can be skipped when nothing moved since the last full run, which changed
+    nothing. A full run is still done at least every `schedule_max_minutes`: the
+    last full run ended a bit after the scheduled time of the next run, so one
+    minimum interval of slack is allowed.
+    """
+    if state is None or fingerprint != state.get('fingerprint') or state.get('lastChanges', 1) > 0:
+        return False
+    max_seconds = (schedule_max_minutes - schedule_min_minutes) * 60
+    return time.time() - state.get('lastFullRunAt', 0) < max_seconds
+
+
+def finish_run(state, fingerprint, changes, skipped=False):
+    """
+    Updates the schedule's rate to the next interval, and then saves the state of the
+    run: if the update fails, the state is not saved and the next run tries again.
+    """
+    if state is None:
+        return
+    interval = next_interval_minutes(state['intervalMinutes'], changes)
+    if schedule_name:
+        update_schedule_rate(interval)
+    new_state = dict(state, fingerprint=fingerprint, intervalMinutes=interval)
+    if not skipped:
+        new_state.update(lastChanges=changes, lastFullRunAt=time.time())
+    aws_client('ssm').put_parameter(
+        Name=schedule_state_parameter,
+        Value=json.dumps(new_state),
+        Overwrite=True
+    )
+    logger.info(f"{'Skipped' if skipped else 'Finished'} run with {changes} changes, next run in {interval} minutes")
+
+
+def update_schedule_rate(minutes):
+    """
+    Updates the schedule if its rate is not the one of `minutes`. The rate is read
+    from the schedule itself, so it's also fixed after a stack update resets it.
+    """
+    scheduler = aws_client('scheduler')
+    schedule = scheduler.get_schedule(Name=schedule_name)
+    if schedule.get('ScheduleExpression') == rate_expression(minutes):
+        return
+    # UpdateSchedule replaces the whole schedule, so the current definition is sent back
+    fields = ['GroupName', 'Description', 'FlexibleTimeWindow', 'Target', 'State', 'ScheduleExpressionTimezone']
+    scheduler.update_schedule(
+        Name=schedule_name,
+        ScheduleExpression=rate_expression(minutes),
+        **{f: schedule[f] for f in fields if f in schedule}
+    )
+    logger.info(f'Updated schedule {schedule_name} to {rate_expression(minutes)}')
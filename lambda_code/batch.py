@@ -0,0 +1,40 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+batch_concurrency = int(os.getenv('BATCH_CONCURRENCY') or 10)
+
+
+def run_batch(calls, concurrency=None):
+    """
+    Runs independent blocking calls (callables without arguments, e.g. boto3
+    requests) concurrently and returns their results in the same order.
+
+    The calls are issued from an asyncio event loop with at most `concurrency`
+    requests in flight. boto3 clients are thread-safe, so each call runs in a worker
+    thread of the loop's executor. If an event loop is already running, the calls
+    run sequentially.
+    """
+    calls = list(calls)
+    concurrency = concurrency or batch_concurrency
+    if len(calls) < 2 or concurrency < 2:
+        return [call() for call in calls]
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_run_batch(calls, concurrency))
+    logger.info('Event loop already running, falling back to sequential calls.')
+    return [call() for call in calls]
+
+
+async def _run_batch(calls, concurrency):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(calls))) as executor:
+        async def run(call):
+            async with semaphore:
+                return await loop.run_in_executor(executor, call)
+        return await asyncio.gather(*[run(call) for call in calls])
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+logger = logging.getLogger()
+
+ACCOUNT_ID_PATTERN = re.compile(r'^\d{12}$')
+OU_ID_PATTERN = re.compile(r'^ou-[0-9a-z]{4,32}-[a-z0-9]{8,32}$')
+ALL_ACCOUNTS = 'ALL'
+METRICS_NAMESPACE = 'VPCLatticeAutomation'
+
+Config = namedtuple('Config', ['allowed_accounts', 'allowlist_enabled', 'stage_names'])
+
+_config = None
+_config_loaded_at = 0
+
+_decision_counters = Counter()
+_decision_counters_lock = threading.Lock()
+
+
+def aws_client(service):
+    # boto3 is imported here, so the configuration can be loaded (and tested) without it
+    import boto3
+    return boto3.client(service)
+
+
+def split_list(value):
+    """
+    Splits a comma (or newline) separated list, ignoring whitespace and empty entries.
+    """
+    return [v.strip() for v in re.split(r'[,\n]', value or '') if v.strip()]
+
+
+def validate_accounts(accounts, source):
+    invalid = [a for a in accounts if a != ALL_ACCOUNTS and not ACCOUNT_ID_PATTERN.match(a)]
+    if invalid:
+        raise Exception(f'Invalid AWS Account IDs in {source}: {invalid}')
+    return accounts
+
+
+def load_parameter_accounts(parameter_name):
+    value = aws_client('ssm').get_parameter(Name=parameter_name)['Parameter']['Value']
+    return validate_accounts(split_list(value), f'SSM parameter {parameter_name}')
+
+
+def list_ou_accounts(organizations, ou_id):
+    """
+    Active accounts of the OU and all its child OUs.
+    """
+    accounts = []
+    for page in organizations.get_paginator('list_accounts_for_parent').paginate(ParentId=ou_id):
+        accounts.extend(a['Id'] for a in page['Accounts'] if a['Status'] == 'ACTIVE')
+    for page in organizations.get_paginator('list_organizational_units_for_parent').paginate(ParentId=ou_id):
+        for child in page['OrganizationalUnits']:
+            accounts.extend(list_ou_accounts(organizations, child['Id']))
+    return accounts
+
+
+def load_ou_accounts(ou_ids):
+    invalid = [ou for ou in ou_ids if not OU_ID_PATTERN.match(ou)]
+    if invalid:
+        raise Exception(f'Invalid OU IDs in ALLOWED_ACCOUNTS_OUS: {invalid}')
+    organizations = aws_client('organizations')
+    accounts = []
+    for ou_id in ou_ids:
+        accounts.extend(list_ou_accounts(organizations, ou_id))
+    logger.info(f'Loaded {len(accounts)} accounts from OUs {ou_ids}')
+    return accounts
+
+
+def load_config():
+    """
+    The allowlist is the union of the ALLOWED_ACCOUNTS environment variable, the
+    accounts in the SSM parameter ALLOWED_ACCOUNTS_PARAMETER, and the accounts in the
+    OUs of ALLOWED_ACCOUNTS_OUS. `ALL` in ALLOWED_ACCOUNTS disables the allowlist.
+    """
+    accounts = validate_accounts(split_list(os.getenv('ALLOWED_ACCOUNTS')), 'ALLOWED_ACCOUNTS')
+    accounts_parameter = os.getenv('ALLOWED_ACCOUNTS_PARAMETER')
+    if accounts_parameter:
+        accounts += load_parameter_accounts(accounts_parameter)
+    accounts_ous = split_list(os.getenv('ALLOWED_ACCOUNTS_OUS'))
+    if accounts_ous:
+        accounts += load_ou_accounts(accounts_ous)
+
+    stage_names = frozenset(s.lower() for s in split_list(os.getenv('STAGE_NAMES')))
+    if not stage_names:
+        logger.warning('STAGE_NAMES is empty: no stage will be allowed.')
+
+    config = Config(
+        allowed_accounts=frozenset(a for a in accounts if a != ALL_ACCOUNTS),
+        allowlist_enabled=ALL_ACCOUNTS not in accounts,
+        stage_names=stage_names
+    )
+    logger.info(f'Loaded {len(config.allowed_accounts)} allowed accounts and stages {sorted(config.stage_names)}')
+    return config
+
+
+def get_config():
+    """
+    Loads and validates the configuration once per container. When the allowlist
+    comes from SSM or AWS Organizations, the local copy is refreshed every
+    ALLOWED_ACCOUNTS_CACHE_SECONDS (default 3600).
+    """
+    global _config, _config_loaded_at
+    remote_sources = os.getenv('ALLOWED_ACCOUNTS_PARAMETER') or os.getenv('ALLOWED_ACCOUNTS_OUS')
+    cache_seconds = int(os.getenv('ALLOWED_ACCOUNTS_CACHE_SECONDS') or 3600)
+    if _config is None or (remote_sources and time.time() - _config_loaded_at > cache_seconds):
+        _config = load_config()
+        _config_loaded_at = time.time()
+    return _config
+
+
+def count_decision(decision):
+    with _decision_counters_lock:
+        _decision_counters[decision] += 1
+
+
+def is_allowed_account(account):
+    config = get_config()
+    allowed = not config.allowlist_enabled or account in config.allowed_accounts
+    count_decision('AccountAllowed' if allowed else 'AccountDenied')
+    return allowed
+
+
+def is_allowed_stage(stage):
+    allowed = stage in get_config().stage_names
+    count_decision('StageAllowed' if allowed else 'StageDenied')
+    return allowed
+
+
+def publish_decision_counters():
+    """
+    Publishes the decision counters of the run as CloudWatch metrics (using the
+    embedded metric format written to stdout, so no API call is needed) and resets them.
+    """
+    with _decision_counters_lock:
+        counters = dict(_decision_counters)
+        _decision_counters.clear()
+    if not counters:
+        return
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function']],
+                'Metrics': [{'Name': name, 'Unit': 'Count'} for name in sorted(counters)]
+            }]
+        },
+        'Function': os.getenv('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    record.update(counters)
+    # CloudWatch only extracts metrics from lines that are just the JSON record, without the logger's prefix
+    print(json.dumps(record), flush=True)
@@ -3,15 +3,22 @@ import os
 import json
 import time
 import sys
+from functools import partial
 
 from pip._internal import main
 
 # ----- TEMPORAL: UPDATE BOTO3 TO HAVE VPC-LATTICE
-main(['install', '-I', '-q', 'boto3', '--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0,'/tmp/')
+# The reconciler imports both accept_shared_service and disassociate_unshared_service: only the first one installs boto3
+if '/tmp/' not in sys.path:
+    main(['install', '-I', '-q', 'boto3', '--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
+    sys.path.insert(0,'/tmp/')
 # -----
 import boto3
 
+from adaptive_schedule import Fingerprint, finish_run, load_schedule_state, should_skip_run
+from discovery import map_calls
+from log_summary import ItemSummary, dumps_capped, log_summary
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -25,45 +32,88 @@ def lambda_handler(event, context):
     # We obtain the map of stages and service networks from SSM Parameter
     stage_to_network = ssm_client.get_parameter(Name=stage_to_network_parameter)['Parameter']['Value']
     stage_to_network_dict = json.loads(stage_to_network)
-    # Obtaining current VPC Lattice service associations in the services networks retrieved
-    associations = []
-    for service_network_arn in stage_to_network_dict.values():
-        associations.extend(get_service_associations(service_network_arn))
-    logger.info(f'Found service associations {json.dumps(associations, default=str)}')
-    # Getting current VPC Lattice services shared (via RAM)
-    service_arns = get_shared_service_arns()
-    logger.info(f'Found shared service arns {service_arns}')
+    # Getting current VPC Lattice services shared (via RAM). Only their ARNs are kept
+    shared_services = ItemSummary('sharedServices', key=lambda s: s['arn'])
+    service_arns = set()
+    fingerprint = Fingerprint()
+    for service in shared_services.track(iter_shared_services()):
+        service_arns.add(service['arn'])
+        fingerprint.add(service['arn'], service.get('lastUpdatedTime'))
+    # If nothing moved since the last run, the association listings are skipped
+    schedule_state = load_schedule_state()
+    if schedule_state is not None:
+        add_service_networks_to_fingerprint(fingerprint, stage_to_network_dict)
+    if should_skip_run(schedule_state, fingerprint.hexdigest()):
+        finish_run(schedule_state, fingerprint.hexdigest(), 0, skipped=True)
+        return
+    # Obtaining the VPC Lattice service associations of services no longer shared with the Account, in the
+    # services networks retrieved. The listings are independent, so they can run concurrently
+    network_associations = map_calls(
+        partial(get_unshared_service_associations, service_arns),
+        list(stage_to_network_dict.values())
+    )
+    log_summary(
+        'Found service associations', shared_services,
+        associations=sum(total for total, _ in network_associations)
+    )
 
     # For those VPC Lattice services associated that are no longer shared with the Account, we remove them
-    num_associations_deleted = 0
-    for association in associations:
-        if association['serviceArn'] not in service_arns:
-            logger.info(f'Deleting association {json.dumps(associations, default=str)}')
-            vpc_lattice_client.delete_service_network_service_association(
-                serviceNetworkServiceAssociationIdentifier=association['id']
-            )
-            num_associations_deleted += 1
-    logger.info(f'Deleted {num_associations_deleted} associations.')
+    deleted = ItemSummary('deletedAssociations', key=lambda a: a['arn'])
+    for _, unshared_associations in network_associations:
+        for association in deleted.track(unshared_associations):
+            delete_association(association)
+    log_summary(f'Deleted {deleted.count} associations.', deleted)
+    finish_run(schedule_state, fingerprint.hexdigest(), deleted.count)
+
+
+def delete_association(association):
+    logger.info(f'Deleting association {dumps_capped(association)}')
+    vpc_lattice_client.delete_service_network_service_association(
+        serviceNetworkServiceAssociationIdentifier=association['id']
+    )
 
 
-def get_service_associations(service_network_identifier):
-    associations = []
+def iter_service_associations(service_network_identifier):
     paginator = vpc_lattice_client.get_paginator('list_service_network_service_associations')
     iterator = paginator.paginate(
         serviceNetworkIdentifier=service_network_identifier
     )
     for iteration in iterator:
-        associations.extend(iteration['items'])
-    return associations
+        yield from iteration['items']
+
+
+def get_unshared_service_associations(service_arns, service_network_identifier):
+    """
+    Streams the associations of the service network and returns how many there are,
+    keeping only the ones whose service is not in `service_arns`.
+    """
+    total = 0
+    unshared_associations = []
+    for association in iter_service_associations(service_network_identifier):
+        total += 1
+        if association['serviceArn'] not in service_arns:
+            unshared_associations.append(association)
+    return total, unshared_associations
+
+
+def add_service_networks_to_fingerprint(fingerprint, stage_to_network_dict):
+    """
+    Adds the stage service networks, with their update times and number of associated
+    services, to the fingerprint of the run.
+    """
+    stage_network_arns = set(stage_to_network_dict.values())
+    paginator = vpc_lattice_client.get_paginator('list_service_networks')
+    for page in paginator.paginate():
+        for sn in page['items']:
+            if sn['arn'] in stage_network_arns:
+                fingerprint.add(sn['arn'], sn.get('lastUpdatedAt'), sn.get('numberOfAssociatedServices'))
 
 
-def get_shared_service_arns():
-    services = []
+def iter_shared_services():
     paginator = ram_client.get_paginator('list_resources')
     iterator = paginator.paginate(
         resourceOwner='OTHER-ACCOUNTS',
         resourceType='vpc-lattice:Service'
     )
     for iteration in iterator:
-        services.extend(iteration['resources'])
-    return [s['arn'] for s in services]
\ No newline at end of file
+        yield from iteration['resources']
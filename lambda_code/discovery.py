@@ -0,0 +1,34 @@
+import logging
+import os
+from functools import partial
+
+from batch import run_batch
+
+logger = logging.getLogger()
+
+# 'async' issues independent discovery reads concurrently, 'sync' one after the other
+discovery_engine = (os.getenv('DISCOVERY_ENGINE') or 'sync').strip().lower()
+discovery_concurrency = int(os.getenv('DISCOVERY_CONCURRENCY') or 10)
+
+
+def run_all(calls, engine=None, concurrency=None):
+    """
+    Runs independent blocking calls (callables without arguments, e.g. boto3
+    requests) and returns their results in the same order.
+
+    With the async engine, the calls run concurrently (see batch.run_batch) with at
+    most `concurrency` requests in flight. With the sync engine, they run one after
+    the other.
+    """
+    calls = list(calls)
+    engine = engine or discovery_engine
+    if engine != 'async':
+        return [call() for call in calls]
+    return run_batch(calls, concurrency or discovery_concurrency)
+
+
+def map_calls(function, items, engine=None, concurrency=None):
+    """
+    Same as `[function(item) for item in items]`, using the configured engine.
+    """
+    return run_all([partial(function, item) for item in items], engine, concurrency)
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import random
+
+logger = logging.getLogger()
+
+# Bounds for what a single log record can contain, whatever the size of the fleet
+log_max_items = int(os.getenv('LOG_MAX_ITEMS') or 20)
+log_max_chars = int(os.getenv('LOG_MAX_CHARS') or 2048)
+log_max_item_chars = int(os.getenv('LOG_MAX_ITEM_CHARS') or 256)
+
+
+def cap_item(value, max_chars=None):
+    """
+    The value if its JSON representation fits in `max_chars` characters, else that
+    representation truncated. The result is always JSON serializable.
+    """
+    max_chars = max_chars or log_max_item_chars
+    dumped = value if isinstance(value, str) else json.dumps(value, default=str)
+    if len(dumped) <= max_chars:
+        return value
+    return f'{dumped[:max_chars]}...'
+
+
+class ItemSummary:
+    """
+    Counts the items of a stream and keeps a bounded random sample of them
+    (reservoir sampling) of capped items, so the memory and log size don't grow with
+    the stream.
+    """
+    def __init__(self, name, key=None, max_items=None):
+        self.name = name
+        self.key = key or (lambda item: item)
+        self.max_items = log_max_items if max_items is None else max_items
+        self.count = 0
+        self.sample = []
+
+    def add(self, item):
+        self.count += 1
+        if len(self.sample) < self.max_items:
+            self.sample.append(cap_item(self.key(item)))
+        else:
+            index = random.randrange(self.count)
+            if index < self.max_items:
+                self.sample[index] = cap_item(self.key(item))
+
+    def track(self, items):
+        """
+        Yields the items of the stream, adding each one to the summary.
+        """
+        for item in items:
+            self.add(item)
+            yield item
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'truncated': self.count > len(self.sample),
+            'sample': self.sample
+        }
+
+
+def dumps_capped(value, max_chars=None):
+    """
+    JSON representation of the value, truncated to `max_chars` characters.
+    """
+    max_chars = max_chars or log_max_chars
+    dumped = json.dumps(value, default=str)
+    if len(dumped) <= max_chars:
+        return dumped
+    return f'{dumped[:max_chars]}... ({len(dumped) - max_chars} more characters)'
+
+
+def log_summary(message, *summaries, **fields):
+    """
+    Emits one structured record with the fields, and the count and the sample of each
+    summary. The samples are bounded (`LOG_MAX_ITEMS` items of `LOG_MAX_ITEM_CHARS`
+    characters), so the record is never truncated and is always valid JSON.
+    """
+    record = {'message': message}
+    record.update(fields)
+    for summary in summaries:
+        record[summary.name] = summary.as_dict()
+    logger.info(json.dumps(record, default=str))
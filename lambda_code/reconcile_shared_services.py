@@ -0,0 +1,161 @@
+import json
+import logging
+import time
+from functools import partial
+
+import accept_shared_service as accept
+import disassociate_unshared_service as disassociate
+from adaptive_schedule import finish_run, load_schedule_state, should_skip_run
+from config import get_config, publish_decision_counters
+from batch import run_batch
+from log_summary import ItemSummary, dumps_capped, log_summary
+from tracing import correlation_from_tags
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def lambda_handler(event, context):
+    """
+    Unified mode of accept_shared_service and disassociate_unshared_service. In a
+    single pass:
+    1. Accepts the allowed resource share invitations.
+    2. Takes one snapshot of the accepted shares and their services, all the services
+    shared with the Account, and the associations of every stage service network.
+    3. Computes the associations to create (allowed shared services not associated to
+    their stage's service network) and to delete (associations of services no longer
+    shared) from that snapshot, and applies them in one parallel batch.
+
+    Given both sets come from the same snapshot, an association is never created and
+    deleted by concurrent runs of the two functions.
+    """
+    logger.info(f'Received event {dumps_capped(event)} and context {context}')
+    # If nothing moved since the last run, the run is skipped
+    schedule_state = load_schedule_state()
+    fingerprint = accept.get_fingerprint() if schedule_state is not None else None
+    if should_skip_run(schedule_state, fingerprint):
+        finish_run(schedule_state, fingerprint, 0, skipped=True)
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Nothing changed since the last run.')
+        }
+    # Loads (or refreshes) the allowlist and stages before the concurrent snapshot
+    get_config()
+    accept.set_stage_to_network_dict()
+    num_accepted = accept.accept_pending_resource_share_invitations()
+    if num_accepted > 0:
+        # We wait 5 seconds for avoid skipping recently accepted shared resources
+        time.sleep(5)
+
+    desired, existing, shared_service_arns = take_snapshot(accept.stage_to_network_dict)
+    adds, removes = plan_changes(desired, existing, shared_service_arns)
+    for key, share in desired.items():
+        if key in existing:
+            trace_existing_association(key, share, existing[key])
+
+    apply_changes(adds, removes)
+    publish_decision_counters()
+    finish_run(schedule_state, fingerprint, num_accepted + len(adds) + len(removes))
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Accepted {num_accepted} invitations, created {len(adds)} and deleted {len(removes)} associations.')
+    }
+
+
+def take_snapshot(stage_to_network_dict):
+    """
+    Returns:
+    - desired: {(service network ARN, service ARN): share} for the services of the
+    allowed shares.
+    - existing: {(service network ARN, service ARN): association} for the stage
+    service networks.
+    - shared_service_arns: ARNs of all the services shared with the Account.
+    """
+    shares = ItemSummary('shares', key=lambda share: share['resourceShareArn'])
+    allowed_shares = []
+    for page in accept.iter_accepted_resource_share_pages():
+        allowed_shares.extend(
+            share for share in shares.track(page)
+            if accept.is_allowed_share(share) and share['name'] in stage_to_network_dict
+        )
+    network_arns = list(set(stage_to_network_dict.values()))
+
+    # All the reads of the snapshot are independent, so they run in one concurrent batch
+    results = run_batch(
+        [partial(accept.get_shared_services, share) for share in allowed_shares]
+        + [partial(list_associations, arn) for arn in network_arns]
+        + [list_shared_service_arns]
+    )
+    share_services = results[:len(allowed_shares)]
+    network_associations = results[len(allowed_shares):-1]
+    shared_service_arns = results[-1]
+
+    desired = {}
+    for share, services in zip(allowed_shares, share_services):
+        for service in services:
+            desired[(stage_to_network_dict[share['name']], service['arn'])] = share
+    existing = {}
+    for associations in network_associations:
+        for a in associations:
+            existing[(a['serviceNetworkArn'], a['serviceArn'])] = a
+
+    log_summary(
+        'Took snapshot', shares,
+        allowedShares=len(allowed_shares),
+        desiredAssociations=len(desired),
+        existingAssociations=len(existing),
+        sharedServices=len(shared_service_arns)
+    )
+    return desired, existing, shared_service_arns
+
+
+def plan_changes(desired, existing, shared_service_arns):
+    """
+    Returns the associations to create (desired but not existing) and to delete
+    (existing, for a service no longer shared with the Account). Given a service in
+    `desired` is shared, an association is never both created and deleted.
+    """
+    adds = [(key, share) for key, share in desired.items() if key not in existing]
+    removes = [a for (_, service_arn), a in existing.items() if service_arn not in shared_service_arns]
+    return adds, removes
+
+
+def list_associations(service_network_identifier):
+    # Only the fields used by the reconciliation are kept
+    return [
+        {k: a.get(k) for k in ['id', 'arn', 'serviceArn', 'serviceNetworkArn', 'status']}
+        for a in disassociate.iter_service_associations(service_network_identifier)
+    ]
+
+
+def list_shared_service_arns():
+    return {s['arn'] for s in disassociate.iter_shared_services()}
+
+
+def trace_existing_association(key, share, association):
+    service_network_arn, service_arn = key
+    correlation_id, origin = correlation_from_tags(share.get('tags'))
+    accept.trace_active_associations(
+        [association], service_network_arn, service_arn, share['name'],
+        share['resourceShareArn'], correlation_id, origin
+    )
+
+
+def create_association(key, share):
+    service_network_arn, service_arn = key
+    correlation_id, origin = correlation_from_tags(share.get('tags'))
+    accept.create_association(
+        service_network_arn, service_arn, share['name'],
+        share['resourceShareArn'], correlation_id, origin
+    )
+
+
+def apply_changes(adds, removes):
+    created = ItemSummary('createdAssociations', key=lambda add: add[0][1])
+    deleted = ItemSummary('deletedAssociations', key=lambda a: a['arn'])
+    # The changes are independent (one association each), so they run in one concurrent batch
+    run_batch(
+        [partial(create_association, key, share) for key, share in created.track(adds)]
+        + [partial(disassociate.delete_association, a) for a in deleted.track(removes)]
+    )
+    log_summary('Applied changes', created, deleted)
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+lock_table_name = os.getenv('LOCK_TABLE_NAME')
+# How long a lease is valid if its owner never releases it (e.g. the function timed out)
+lock_lease_seconds = int(os.getenv('LOCK_LEASE_SECONDS') or 120)
+# How long an event waits for the lease of its resource before failing (and being retried)
+lock_wait_seconds = int(os.getenv('LOCK_WAIT_SECONDS') or 25)
+# How long the handler needs once it holds the lease: the wait never eats into it
+lock_work_seconds = int(os.getenv('LOCK_WORK_SECONDS') or 15)
+
+
+class DynamoDBLockBackend:
+    """
+    Leases and state records stored in a DynamoDB table with partition key
+    `resourceId` (String). Each resource is an independent item, so events for
+    different resources never contend.
+    """
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        if client is None:
+            # Only this backend needs boto3, the in-memory one runs anywhere
+            import boto3
+            client = boto3.client('dynamodb')
+        self.client = client
+
+    def acquire(self, key, owner, lease_seconds):
+        now = time.time()
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'resourceId': {'S': key}},
+                UpdateExpression='SET leaseOwner = :owner, leaseExpiresAt = :expires',
+                ConditionExpression='attribute_not_exists(leaseOwner) OR leaseExpiresAt < :now OR leaseOwner = :owner',
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner},
+                    ':expires': {'N': str(now + lease_seconds)},
+                    ':now': {'N': str(now)}
+                }
+            )
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def release(self, key, owner):
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'resourceId': {'S': key}},
+                UpdateExpression='REMOVE leaseOwner, leaseExpiresAt',
+                ConditionExpression='leaseOwner = :owner',
+                ExpressionAttributeValues={':owner': {'S': owner}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            logger.warning(f'Lease of {key} was lost before being released by {owner}')
+
+    def get_state(self, key):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'resourceId': {'S': key}},
+            ConsistentRead=True
+        ).get('Item', {})
+        return json.loads(item['state']['S']) if 'state' in item else {}
+
+    def put_state(self, key, owner, state):
+        # Only the current lease owner can write the state
+        self.client.update_item(
+            TableName=self.table_name,
+            Key={'resourceId': {'S': key}},
+            UpdateExpression='SET #state = :state',
+            ConditionExpression='leaseOwner = :owner',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={
+                ':state': {'S': json.dumps(state, default=str)},
+                ':owner': {'S': owner}
+            }
+        )
+
+
+class InMemoryLockBackend:
+    """
+    Same semantics as DynamoDBLockBackend, for local runs and tests. Leases are
+    only shared by the threads of the process.
+    """
+    def __init__(self):
+        self.items = {}
+        self.mutex = threading.Lock()
+
+    def acquire(self, key, owner, lease_seconds):
+        now = time.time()
+        with self.mutex:
+            item = self.items.setdefault(key, {})
+            if item.get('leaseOwner') not in (None, owner) and item['leaseExpiresAt'] >= now:
+                return False
+            item['leaseOwner'] = owner
+            item['leaseExpiresAt'] = now + lease_seconds
+            return True
+
+    def release(self, key, owner):
+        with self.mutex:
+            item = self.items.get(key, {})
+            if item.get('leaseOwner') != owner:
+                logger.warning(f'Lease of {key} was lost before being released by {owner}')
+                return
+            item.pop('leaseOwner')
+            item.pop('leaseExpiresAt')
+
+    def get_state(self, key):
+        with self.mutex:
+            return json.loads(self.items.get(key, {}).get('state', '{}'))
+
+    def put_state(self, key, owner, state):
+        with self.mutex:
+            item = self.items.get(key, {})
+            if item.get('leaseOwner') != owner:
+                raise Exception(f'Cannot update state of {key}: lease not owned by {owner}')
+            item['state'] = json.dumps(state, default=str)
+
+
+class ResourceLease:
+    def __init__(self, backend, key, owner):
+        self.backend = backend
+        self.key = key
+        self.owner = owner
+        self.state = backend.get_state(key)
+
+    def save_state(self, state):
+        self.backend.put_state(self.key, self.owner, state)
+        self.state = state
+
+    def is_stale(self, event_time):
+        """
+        An event older than the last one processed for the resource (events can be
+        delivered out of order) must not overwrite its result.
+        """
+        last_event_time = self.state.get('eventTime')
+        return bool(event_time and last_event_time and event_time < last_event_time)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = DynamoDBLockBackend(lock_table_name) if lock_table_name else InMemoryLockBackend()
+    return _backend
+
+
+def remaining_seconds(context):
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return context.get_remaining_time_in_millis() / 1000
+
+
+@contextmanager
+def resource_lock(key, owner=None, wait_seconds=None, lease_seconds=None, backend=None, context=None):
+    """
+    Serializes the processing of a resource: waits until the lease of `key` is free,
+    and yields a ResourceLease with the resource's state record. Raises an Exception
+    if the lease can't be obtained in `wait_seconds`.
+
+    With the Lambda `context`, the wait leaves `lock_work_seconds` of the invocation
+    for the handler, and the lease lasts as long as the invocation: a handler that
+    times out holding it only blocks the resource for the rest of its invocation.
+    """
+    backend = backend or get_backend()
+    owner = owner or getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    wait_seconds = lock_wait_seconds if wait_seconds is None else wait_seconds
+    lease_seconds = lease_seconds or lock_lease_seconds
+    if remaining_seconds(context) is not None:
+        wait_seconds = max(0, min(wait_seconds, remaining_seconds(context) - lock_work_seconds))
+
+    timeout = time.time() + wait_seconds
+    delay = 0.1
+    while True:
+        if remaining_seconds(context) is not None:
+            lease_seconds = remaining_seconds(context) + 1
+        if backend.acquire(key, owner, lease_seconds):
+            break
+        if time.time() > timeout:
+            raise Exception(f'Timed out waiting for the lease of {key}')
+        time.sleep(delay)
+        delay = min(delay * 2, 2)
+    try:
+        yield ResourceLease(backend, key, owner)
+    finally:
+        backend.release(key, owner)
@@ -1,10 +1,8 @@
-from functools import lru_cache
-
 import json
 import logging
 import time
 import sys
-import os
+from functools import partial
 
 from pip._internal import main
 
@@ -14,15 +12,18 @@ sys.path.insert(0,'/tmp/')
 # -----
 import boto3
 
+from log_summary import dumps_capped
+from resource_lock import resource_lock
+from topology_snapshot import find_network_by_name, record_networks, save_snapshot
+from tracing import active_wait_seconds, correlation_from_event, trace, trace_when_active
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 vpc_lattice = boto3.client('vpc-lattice')
-ssm = boto3.client('ssm')
+# Associations created by the invocation, traced as ACTIVE once the service's lease is released
+pending_active_traces = []
 
-parameter_name = os.environ.get("PARAMETER_NAME")
-
-@lru_cache(maxsize=None)
 def list_all_service_networks():
     response = vpc_lattice.list_service_networks()
     service_networks = response['items'][:]
@@ -39,7 +40,17 @@ def get_service_network_for_stage(stage):
     shared to/created in this account, the first one found will be returned. This is
     because one service network can be associated to one VPC.
     """
+    # A service network from the warm-start snapshot only needs to be validated, not listed again
+    service_network = find_network_by_name(stage.lower())
+    if service_network is not None:
+        try:
+            current = vpc_lattice.get_service_network(serviceNetworkIdentifier=service_network['arn'])
+            if current['name'] == service_network['name']:
+                return service_network
+        except vpc_lattice.exceptions.ResourceNotFoundException:
+            pass
     service_networks = list_all_service_networks()
+    record_networks(service_networks)
     return next((sn for sn in service_networks if sn['name'] == stage.lower()), None)
 
 def get_stage(event):
@@ -48,13 +59,15 @@ def get_stage(event):
         if k.lower() == 'stage':
             return v.lower()
 
-def get_current_stage():
-    return ssm.get_parameter(Name=parameter_name)['Parameter']['Value']
+def get_current_stage(lease):
+    # The stage the service is currently associated with is kept in the service's state record
+    return lease.state.get('stage')
 
-def handle_create_tags(event, context):
+def handle_create_tags(event, context, lease):
     # Getting information: VPC Lattice service ARN, stage, and VPC Lattice service network
     service_arn = event['resources'][0]
     stage = get_stage(event)
+    correlation_id, origin = correlation_from_event(event)
     service_network = get_service_network_for_stage(stage)
 
     # Is our VPC Lattice service already associated to a service network?
@@ -64,6 +77,11 @@ def handle_create_tags(event, context):
     )['items'][:]
     # If the service is already associated to the service network we want, all good!
     if stage in [a['serviceNetworkName'] for a in associations]:
+        lease.save_state({'stage': stage, 'eventTime': event.get('time')})
+        trace(
+            'service_association_exists', correlation_id, origin, service_arn, stage,
+            status=next(a.get('status') for a in associations if a['serviceNetworkName'] == stage)
+        )
         return {
             'statusCode': 200,
             'body': {
@@ -72,8 +90,8 @@ def handle_create_tags(event, context):
         }
 
     # If there's already an association to a Service Network, we remove that association
-    current_stage = get_current_stage()
-    if current_stage != ' ':
+    current_stage = get_current_stage(lease)
+    if current_stage:
         old_stage_associations = [
             a for a in associations
             if a['serviceNetworkName'] == current_stage
@@ -89,14 +107,23 @@ def handle_create_tags(event, context):
         serviceIdentifier=service_arn,
         serviceNetworkIdentifier=service_network['id']
     )
-    # We update the parameter with the new stage
-    udpate_parameter = ssm.put_parameter(
-        Name = parameter_name,
-        Value = stage,
-        Overwrite=True
-    )
+    # We update the service's state record with the new stage
+    lease.save_state({'stage': stage, 'eventTime': event.get('time')})
     
-    logger.info(f'Created association {json.dumps(association, default=str)}')
+    logger.info(f'Created association {dumps_capped(association)}')
+    trace(
+        'service_association_created', correlation_id, origin, service_arn, stage,
+        serviceNetwork=service_network['arn'],
+        status=association.get('status')
+    )
+    pending_active_traces.append(partial(
+        trace_when_active,
+        lambda: vpc_lattice.get_service_network_service_association(
+            serviceNetworkServiceAssociationIdentifier=association['id']
+        )['status'],
+        correlation_id, origin, service_arn, stage,
+        serviceNetwork=service_network['arn']
+    ))
     return {
         'statusCode': 200,
         'body': {
@@ -110,9 +137,9 @@ def delete_service_network_service_associations(associations):
         vpc_lattice.delete_service_network_service_association(
             serviceNetworkServiceAssociationIdentifier=association['id']
         )
-        logger.info(f'Deleted association {json.dumps(association, default=str)}')
+        logger.info(f'Deleted association {dumps_capped(association)}')
 
-def handle_delete_tags(event, context):
+def handle_delete_tags(event, context, lease):
     """
     Deletes a service's associations with all stage-specific service networks.
     """
@@ -122,18 +149,19 @@ def handle_delete_tags(event, context):
     )['items'][:]
 
     # We get current stage
-    current_stage = get_current_stage()
+    current_stage = get_current_stage(lease)
     # We obtain the associations
     stage_associations = [a for a in associations if a['serviceNetworkName'] == current_stage]
     delete_service_network_service_associations(stage_associations)
-
-    # We update the parameter with an 'empty stage'
-    udpate_parameter = ssm.put_parameter(
-        Name = parameter_name,
-        Value = ' ',
-        Overwrite=True
+    correlation_id, origin = correlation_from_event(event)
+    trace(
+        'service_association_deleted', correlation_id, origin, service_arn, current_stage,
+        count=len(stage_associations)
     )
 
+    # We update the service's state record with an 'empty stage'
+    lease.save_state({'stage': None, 'eventTime': event.get('time')})
+
     return {
         'statusCode': 200,
         'body': {
@@ -143,16 +171,43 @@ def handle_delete_tags(event, context):
 
 
 def lambda_handler(event, context):
-    logger.info(f'Event: {json.dumps(event)}')
+    logger.info(f'Event: {dumps_capped(event)}')
     
-    if 'stage' in event['detail']['tags']:
-        return handle_create_tags(event, context)
-    else:
-        return handle_delete_tags(event, context)
+    service_arn = event['resources'][0]
+    try:
+        # Events for the same service are processed one at a time, events for different services concurrently
+        with resource_lock(service_arn, context=context) as lease:
+            if lease.is_stale(event.get('time')):
+                logger.info(f'Ignoring event older than the last one processed for {service_arn}.')
+                return {
+                    'statusCode': 200,
+                    'body': {
+                        'message': 'Stale event ignored.'
+                    }
+                }
+            try:
+                if 'stage' in event['detail']['tags']:
+                    return handle_create_tags(event, context, lease)
+                else:
+                    return handle_delete_tags(event, context, lease)
+            finally:
+                save_snapshot()
+    finally:
+        trace_pending_active_associations(context)
 
     return {
         'statusCode': 400,
         'body': {
             'message': json.dumps(f'Invalid event input.')
         }
-    }
\ No newline at end of file
+    }
+
+
+def trace_pending_active_associations(context):
+    """
+    Waits for the associations created by the invocation to be ACTIVE, to record it.
+    Runs after the lease is released, so events for the same resource don't wait
+    for it.
+    """
+    while pending_active_traces:
+        pending_active_traces.pop()(wait_seconds=active_wait_seconds(context))
@@ -1,19 +1,19 @@
 import json
 import boto3
 import logging
-import os
+
+from config import get_config
+from log_summary import dumps_capped
+from tracing import correlation_from_event, correlation_tags, trace
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-allowed_accounts_env = os.getenv('ALLOWED_ACCOUNTS')
-if allowed_accounts_env is None:
-    raise Exception('Missing ALLOWED_ACCOUNTS environment variable!')
-else:
-    allowed_accounts = allowed_accounts_env.split(',')
-
-stage_names_env = os.getenv('STAGE_NAMES') or ''
-stage_names = [k.strip().lower() for k in stage_names_env.split(',')]
+# The allowed accounts and stages are loaded (and validated) once per container
+if not get_config().allowed_accounts:
+    if not get_config().allowlist_enabled:
+        raise Exception('ALLOWED_ACCOUNTS is ALL, but resource shares need the AWS Accounts to share with!')
+    raise Exception('No allowed AWS Accounts found in ALLOWED_ACCOUNTS, ALLOWED_ACCOUNTS_PARAMETER or ALLOWED_ACCOUNTS_OUS!')
 
 ram = boto3.client('ram')
 
@@ -30,6 +30,7 @@ def handle_create_tags(event, context):
     """
     service_network_arn = event['resources'][0]
     stage = get_stage(event)
+    correlation_id, origin = correlation_from_event(event)
 
     existing_shares = ram.get_resource_shares(
         resourceOwner='SELF',
@@ -43,12 +44,13 @@ def handle_create_tags(event, context):
     for share in existing_shares:
         if share['name'] == stage and share['status'] in ['PENDING', 'ACTIVE']:
             already_shared = True
-        elif share['name'] in stage_names:
+        elif share['name'] in get_config().stage_names:
             ram.delete_resource_share(
                 resourceShareArn=share['resourceShareArn']
             )
               
     if already_shared:
+        trace('share_exists', correlation_id, origin, service_network_arn, stage)
         return {
             'statusCode': 200,
             'body': {
@@ -56,16 +58,21 @@ def handle_create_tags(event, context):
             }
         }
                   
+    # Only new shares get the allowlist as refreshed from SSM or AWS Organizations (see README)
     share = ram.create_resource_share(
         name=stage,
-        principals=allowed_accounts,
+        principals=sorted(get_config().allowed_accounts),
         resourceArns=[service_network_arn],
         tags=[{
             'key': 'serviceId',
             'value': service_network_arn.split('/')[-1]
-        }]
+        }] + correlation_tags(correlation_id, origin)
+    )
+    logger.info(f'Created new resource share {dumps_capped(share)}')
+    trace(
+        'share_created', correlation_id, origin, service_network_arn, stage,
+        share=share['resourceShare']['resourceShareArn']
     )
-    logger.info(f'Created new resource share {json.dumps(share, default=str)}')
     
     return {
         'statusCode': 200,
@@ -91,7 +98,7 @@ def handle_delete_tags(event, context):
     shares_to_delete = [s for s in existing_shares if s['status'] not in ['DELETED', 'DELETING']]
               
     for share in shares_to_delete:
-        if share['name'] in stage_names:
+        if share['name'] in get_config().stage_names:
             ram.delete_resource_share(
                 resourceShareArn=share['resourceShareArn']
             )
@@ -105,7 +112,7 @@ def handle_delete_tags(event, context):
 
 
 def lambda_handler(event, context):
-    logger.info(f'Event: {json.dumps(event)}')
+    logger.info(f'Event: {dumps_capped(event)}')
               
     if 'stage' in event['detail']['tags']:
         return handle_create_tags(event, context)
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import time
+
+import boto3
+
+from discovery import map_calls
+
+logger = logging.getLogger()
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PATH = '/tmp/topology-snapshot.json'
+
+# Optional shared store (S3), so new containers start from the snapshot of the others
+snapshot_bucket = os.getenv('SNAPSHOT_BUCKET')
+snapshot_key = os.getenv('SNAPSHOT_KEY') or 'snapshots/topology.json'
+# Stage tags changes don't update the service network, so entries are re-checked after this age
+snapshot_max_age_seconds = int(os.getenv('SNAPSHOT_MAX_AGE_SECONDS') or 900)
+
+_snapshot = None
+_dirty = False
+
+
+def empty_snapshot():
+    return {'version': SNAPSHOT_VERSION, 'savedAt': 0, 'etag': None, 'networks': {}}
+
+
+def read_local_snapshot():
+    try:
+        with open(SNAPSHOT_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_shared_snapshot(etag=None):
+    """
+    Returns None if there's no shared snapshot, or if it's the one with `etag`.
+    """
+    s3 = boto3.client('s3')
+    try:
+        kwargs = {'IfNoneMatch': etag} if etag else {}
+        response = s3.get_object(Bucket=snapshot_bucket, Key=snapshot_key, **kwargs)
+    except s3.exceptions.NoSuchKey:
+        return None
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ['304', 'NotModified']:
+            return None
+        raise
+    snapshot = json.loads(response['Body'].read())
+    snapshot['etag'] = response['ETag']
+    return snapshot
+
+
+def get_snapshot():
+    """
+    Loads the snapshot on first use: from /tmp (warm container), else from the shared
+    store. A snapshot with another format version is discarded.
+    """
+    global _snapshot
+    if _snapshot is not None:
+        return _snapshot
+    snapshot = read_local_snapshot()
+    if snapshot_bucket and (snapshot is None or time.time() - snapshot.get('savedAt', 0) > snapshot_max_age_seconds):
+        try:
+            snapshot = read_shared_snapshot(snapshot and snapshot.get('etag')) or snapshot
+        except Exception as e:
+            logger.warning(f'Could not read shared snapshot: {e}')
+    if snapshot is None or snapshot.get('version') != SNAPSHOT_VERSION:
+        snapshot = empty_snapshot()
+    logger.info(f"Loaded topology snapshot with {len(snapshot['networks'])} service networks")
+    _snapshot = snapshot
+    return _snapshot
+
+
+def is_valid_entry(entry, sn):
+    """
+    An entry is still valid if the service network was not updated since it was
+    checked, and it's not older than `snapshot_max_age_seconds`.
+    """
+    return (
+        entry is not None
+        and 'stage' in entry
+        and entry.get('lastUpdatedAt') == str(sn.get('lastUpdatedAt'))
+        and time.time() - entry.get('validatedAt', 0) < snapshot_max_age_seconds
+    )
+
+
+def record_networks(service_networks, stages=None):
+    """
+    Updates the snapshot entries of the service networks (from a listing), and
+    their stages if known. The snapshot only needs to be written again if a
+    service network was added, updated, or changed stage.
+    """
+    global _dirty
+    snapshot = get_snapshot()
+    networks = snapshot['networks']
+    now = time.time()
+    changed = False
+    for i, sn in enumerate(service_networks):
+        entry = networks.setdefault(sn['arn'], {})
+        fields = {'id': sn['id'], 'name': sn['name'], 'lastUpdatedAt': str(sn.get('lastUpdatedAt'))}
+        if any(entry.get(k) != v for k, v in fields.items()):
+            changed = True
+            if stages is None:
+                # The stage of a new or updated service network has to be looked up again
+                entry.pop('stage', None)
+        entry.update(fields)
+        entry.update({
+            'numberOfAssociatedServices': sn.get('numberOfAssociatedServices'),
+            'numberOfAssociatedVPCs': sn.get('numberOfAssociatedVPCs'),
+            'seenAt': now
+        })
+        if stages is not None:
+            if 'stage' not in entry or entry['stage'] != stages[i]:
+                changed = True
+            entry.update({'stage': stages[i], 'validatedAt': now})
+    # When only the validation times moved, the stored copy is refreshed once it's half expired
+    if changed or now - snapshot.get('savedAt', 0) > snapshot_max_age_seconds / 2:
+        _dirty = True
+
+
+def resolve_network_stages(service_networks, lookup_stage):
+    """
+    Returns the stage of each service network (from a listing). Only the service
+    networks that are new, were updated, or have expired in the snapshot are looked
+    up (concurrently) with `lookup_stage`.
+    """
+    networks = get_snapshot()['networks']
+    stale = [sn for sn in service_networks if not is_valid_entry(networks.get(sn['arn']), sn)]
+    if stale:
+        record_networks(stale, map_calls(lookup_stage, stale))
+    logger.debug(f'Resolved stages of {len(service_networks)} service networks, {len(stale)} looked up')
+    return [networks[sn['arn']]['stage'] for sn in service_networks]
+
+
+def verify_network_stage(sn, lookup_stage):
+    """
+    Looks up again the stage of a service network chosen from the snapshot, before
+    acting on it: stage tag changes don't update the service network, so its entry
+    can be outdated. Returns the current stage and updates the entry.
+    """
+    stage = lookup_stage(sn)
+    record_networks([sn], [stage])
+    return stage
+
+
+def find_network_by_name(name):
+    """
+    Service network of the snapshot with the name, as a service network summary.
+    """
+    networks = get_snapshot()['networks']
+    return next(
+        ({'arn': arn, 'id': entry['id'], 'name': entry['name']} for arn, entry in networks.items() if entry.get('name') == name),
+        None
+    )
+
+
+def merge_snapshot(snapshot, other):
+    """
+    Keeps the most recently validated entry of each service network.
+    """
+    for arn, entry in other['networks'].items():
+        current = snapshot['networks'].get(arn)
+        if current is None or entry.get('validatedAt', 0) > current.get('validatedAt', 0):
+            snapshot['networks'][arn] = entry
+
+
+def write_shared_snapshot(snapshot):
+    """
+    Writes the snapshot only if the shared one is still the one it was read from
+    (same ETag). If another container wrote it in between, its entries are merged
+    and the write is tried once more.
+    """
+    s3 = boto3.client('s3')
+    for attempt in range(2):
+        etag = snapshot.get('etag')
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        body = json.dumps({k: v for k, v in snapshot.items() if k != 'etag'})
+        try:
+            snapshot['etag'] = s3.put_object(
+                Bucket=snapshot_bucket,
+                Key=snapshot_key,
+                Body=body.encode(),
+                **condition
+            )['ETag']
+            return
+        except s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict', '412', '409'] or attempt > 0:
+                raise
+        other = read_shared_snapshot()
+        if other is None or other.get('version') != SNAPSHOT_VERSION:
+            snapshot['etag'] = None
+            continue
+        merge_snapshot(snapshot, other)
+        snapshot['etag'] = other['etag']
+
+
+def save_snapshot():
+    """
+    Writes the snapshot to /tmp and to the shared store, if it changed.
+    """
+    global _dirty
+    if not _dirty:
+        return
+    snapshot = get_snapshot()
+    now = time.time()
+    # Entries not seen in a listing for a long time belong to deleted service networks
+    snapshot['networks'] = {
+        arn: entry for arn, entry in snapshot['networks'].items()
+        if now - entry.get('seenAt', 0) < 10 * snapshot_max_age_seconds
+    }
+    snapshot['savedAt'] = now
+    if snapshot_bucket:
+        try:
+            write_shared_snapshot(snapshot)
+        except Exception as e:
+            logger.warning(f'Could not write shared snapshot: {e}')
+    tmp_path = f'{SNAPSHOT_PATH}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+    _dirty = False
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger()
+
+# Marker used by tools/convergence_report.py to find trace records in the logs
+TRACE_MARKER = 'convergence'
+# Tag keys used to carry the correlation information on RAM resource shares
+CORRELATION_TAG_KEY = 'correlationId'
+ORIGIN_TAG_KEY = 'stageChangedAt'
+# How long the association functions wait for a new association to be ACTIVE, to record it
+trace_active_wait_seconds = int(os.getenv('TRACE_ACTIVE_WAIT_SECONDS') or 15)
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def correlation_from_event(event):
+    """
+    The EventBridge event ID and time identify the `stage` tag change. Both the
+    association and the share Lambda functions receive the same event, so they
+    report the same correlation ID.
+    """
+    return event.get('id'), event.get('time')
+
+
+def correlation_tags(correlation_id, origin):
+    """
+    RAM tags used to propagate the correlation information to the Accounts the
+    resource is shared with.
+    """
+    tags = []
+    if correlation_id:
+        tags.append({'key': CORRELATION_TAG_KEY, 'value': correlation_id})
+    if origin:
+        tags.append({'key': ORIGIN_TAG_KEY, 'value': origin})
+    return tags
+
+
+def correlation_from_tags(tags):
+    tags_dict = {t['key']: t['value'] for t in tags or []}
+    return tags_dict.get(CORRELATION_TAG_KEY), tags_dict.get(ORIGIN_TAG_KEY)
+
+
+def trace(step, correlation_id=None, origin=None, resource=None, stage=None, **fields):
+    """
+    Emits a structured log record for a step in the path from a `stage` tag change
+    to an ACTIVE association.
+    """
+    record = {
+        'trace': TRACE_MARKER,
+        'step': step,
+        'ts': now(),
+        'correlationId': correlation_id,
+        'origin': origin,
+        'resource': resource,
+        'stage': stage,
+    }
+    record.update(fields)
+    logger.info(json.dumps(record, default=str))
+
+
+def active_wait_seconds(context=None):
+    """
+    How long to wait for a new association to be ACTIVE: at most
+    `trace_active_wait_seconds`, ending before the Lambda invocation does.
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return trace_active_wait_seconds
+    return min(trace_active_wait_seconds, context.get_remaining_time_in_millis() / 1000 - 2)
+
+
+def trace_when_active(get_status, correlation_id=None, origin=None, resource=None, stage=None, wait_seconds=None, **fields):
+    """
+    Polls `get_status` (the status of a new association) while the association is
+    being created, for at most `wait_seconds`, and records the `association_active`
+    step once it's ACTIVE. Returns the last status seen.
+    """
+    wait_seconds = trace_active_wait_seconds if wait_seconds is None else wait_seconds
+    timeout = time.time() + wait_seconds
+    status = get_status()
+    while status == 'CREATE_IN_PROGRESS' and time.time() < timeout:
+        time.sleep(1)
+        status = get_status()
+    if status == 'ACTIVE':
+        trace('association_active', correlation_id, origin, resource, stage, status=status, **fields)
+    else:
+        logger.info(f'Association of {resource} is {status}, not recorded as ACTIVE')
+    return status
@@ -3,6 +3,7 @@ import logging
 import time
 import sys
 import os
+from functools import partial
 
 from pip._internal import main
 
@@ -12,23 +13,49 @@ sys.path.insert(0,'/tmp/')
 # -----
 import boto3
 
+from log_summary import dumps_capped
+from resource_lock import resource_lock
+from topology_snapshot import resolve_network_stages, save_snapshot, verify_network_stage
+from tracing import active_wait_seconds, correlation_from_event, trace, trace_when_active
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 vpc_lattice = boto3.client('vpc-lattice')
+# Associations created by the invocation, traced as ACTIVE once the VPC's lease is released
+pending_active_traces = []
 ram = boto3.client("ram")
 my_account = os.getenv("MY_ACCOUNT")
 
-def list_all_service_networks():
+def iter_service_network_pages():
     response = vpc_lattice.list_service_networks()
-    service_networks = response['items'][:]
+    yield response['items']
     while 'nextToken' in response:
         response = vpc_lattice.list_service_networks(
             nextToken=response['nextToken']
         )
-        service_networks += response['items']
-    
-    return service_networks
+        yield response['items']
+
+def get_service_network_stage(sn):
+    """
+    Different way to obtain the stage depending the AWS Account owner:
+    - If the service network is part of the same Account, we get the stage from the tag.
+    - From a different Account, from the RAM share name
+    """
+    sn_account = sn['arn'].split(':')[4]
+    if sn_account == my_account:
+        tags = vpc_lattice.list_tags_for_resource(resourceArn=sn['arn'])['tags']
+        return tags.get('stage')
+    # Getting Resource Share from Service Network ARN
+    ram_resource_share = ram.list_resources(
+        resourceOwner = 'OTHER-ACCOUNTS',
+        resourceArns = [sn['arn']]
+    )['resources'][0]['resourceShareArn']
+    # Getting stage from Resource Share Name
+    return ram.get_resource_shares(
+        resourceOwner = 'OTHER-ACCOUNTS',
+        resourceShareArns = [ram_resource_share]
+    )['resourceShares'][0]['name']
 
 def get_service_network_for_stage(stage):
     """
@@ -37,36 +64,16 @@ def get_service_network_for_stage(stage):
     will be returned. This is because a VPC can have one service network
     associated to it.
     """
-    service_networks = list_all_service_networks()
-    """
-    Different way to obtain the stage depending the AWS Account owner:
-    - If the service network is part of the same Account, we get the stage from the tag.
-    - From a different Account, from the RAM share name
-    """
-    service_networks_stage = []
-    for sn in service_networks:
-        sn_account = sn['arn'].split(':')[4]
-        if sn_account == my_account:
-            tags = vpc_lattice.list_tags_for_resource(resourceArn=sn['arn'])['tags']
-            if 'stage' in tags.keys():
-                if tags['stage'] == stage:
-                    service_networks_stage.append(sn)
-        else:
-            # Getting Resource Share from Service Network ARN
-            ram_resource_share = ram.list_resources(
-                resourceOwner = 'OTHER-ACCOUNTS',
-                resourceArns = [sn['arn']]
-            )['resources'][0]['resourceShareArn']
-            # Getting stage from Resource Share Name
-            resource_share_name = ram.get_resource_shares(
-                resourceOwner = 'OTHER-ACCOUNTS',
-                resourceShareArns = [ram_resource_share]
-            )['resourceShares'][0]['name']
-            # We add the Service Network if it's part of the desired stage
-            if resource_share_name == stage:
-                service_networks_stage.append(sn)
+    # Service networks are checked one page at a time, stopping at the first match
+    for service_networks in iter_service_network_pages():
+        # Stages come from the warm-start snapshot, only new or updated service networks are looked up
+        service_networks_stages = resolve_network_stages(service_networks, get_service_network_stage)
+        for sn, sn_stage in zip(service_networks, service_networks_stages):
+            # The stage of the candidate is checked again, the snapshot can miss a stage tag change
+            if sn_stage == stage and verify_network_stage(sn, get_service_network_stage) == stage:
+                return sn
     
-    return next((sn for sn in service_networks_stage), None)
+    return None
 
 def get_stage(event):
     tag_changes = event['detail']['requestParameters']['tagSet']['items']
@@ -74,10 +81,11 @@ def get_stage(event):
         if tag_change['key'].lower() == 'stage':
             return tag_change['value'].lower()
 
-def handle_create_tags(event, context):
+def handle_create_tags(event, context, lease):
     # Getting information: VPC ID, stage (from EventBridge event), and VPC Lattice service network
     vpc_id = event['detail']['requestParameters']['resourcesSet']['items'][0]['resourceId']
     stage = get_stage(event)
+    correlation_id, origin = correlation_from_event(event)
     service_network = get_service_network_for_stage(stage)
     
     # Is our VPC already associated to a VPC Lattice service network?
@@ -88,7 +96,8 @@ def handle_create_tags(event, context):
     # If the service network is already the one we want to associate, all good!
     for a in associations:
         if stage in a['serviceNetworkName']:
-            print()
+            lease.save_state({'stage': stage, 'serviceNetwork': a['serviceNetworkArn'], 'eventTime': event.get('time')})
+            trace('vpc_association_exists', correlation_id, origin, vpc_id, stage, status=a.get('status'))
             return {
                 'statusCode': 409,
                 'body': {
@@ -113,7 +122,21 @@ def handle_create_tags(event, context):
     )
 
     
-    logger.info(f'Created association {json.dumps(association, default=str)}')
+    logger.info(f'Created association {dumps_capped(association)}')
+    lease.save_state({'stage': stage, 'serviceNetwork': service_network['arn'], 'eventTime': event.get('time')})
+    trace(
+        'vpc_association_created', correlation_id, origin, vpc_id, stage,
+        serviceNetwork=service_network['arn'],
+        status=association.get('status')
+    )
+    pending_active_traces.append(partial(
+        trace_when_active,
+        lambda: vpc_lattice.get_service_network_vpc_association(
+            serviceNetworkVpcAssociationIdentifier=association['id']
+        )['status'],
+        correlation_id, origin, vpc_id, stage,
+        serviceNetwork=service_network['arn']
+    ))
     return {
         'statusCode': 200,
         'body': {
@@ -122,7 +145,7 @@ def handle_create_tags(event, context):
     }
 
 
-def handle_delete_tags(event, context):
+def handle_delete_tags(event, context, lease):
     """
     Deletes a VPC's association with a stage-specific service network.
     """
@@ -134,10 +157,19 @@ def handle_delete_tags(event, context):
     associations = vpc_lattice.list_service_network_vpc_associations(
         vpcIdentifier=vpc_id
     )['items']
-    stage_associations = [a for a in associations if a['serviceNetworkArn'] == get_service_network_for_stage(stage)['arn']]
+    # The service network the VPC is associated with is kept in the VPC's state record
+    service_network_arn = lease.state.get('serviceNetwork')
+    if service_network_arn is None:
+        # VPCs associated before the state record existed
+        service_network = get_service_network_for_stage(stage)
+        service_network_arn = service_network and service_network['arn']
+    stage_associations = [a for a in associations if a['serviceNetworkArn'] == service_network_arn]
     
     # We remove the VPC association
     delete_service_network_vpc_associations(stage_associations)
+    lease.save_state({'stage': None, 'serviceNetwork': None, 'eventTime': event.get('time')})
+    correlation_id, origin = correlation_from_event(event)
+    trace('vpc_association_deleted', correlation_id, origin, vpc_id, stage, count=len(stage_associations))
     
     return {
         'statusCode': 200,
@@ -151,12 +183,12 @@ def delete_service_network_vpc_associations(associations):
         vpc_lattice.delete_service_network_vpc_association(
             serviceNetworkVpcAssociationIdentifier=association['id']
         )
-        logger.info(f'Deleted association {json.dumps(association, default=str)}')
+        logger.info(f'Deleted association {dumps_capped(association)}')
     if len(associations) > 0:
         timeout = time.time() + 60
         while True:
             if time.time() > timeout:
-                raise Exception(f'Timed out waiting for previous associations {json.dumps(associations, default=str)} to be deleted')
+                raise Exception(f'Timed out waiting for previous associations {dumps_capped(associations)} to be deleted')
             for association in associations:
                 try:
                     vpc_lattice.get_service_network_vpc_association(
@@ -168,17 +200,44 @@ def delete_service_network_vpc_associations(associations):
                     return
     
 def lambda_handler(event, context):
-    logger.info(f'Event: {json.dumps(event)}')
+    logger.info(f'Event: {dumps_capped(event)}')
     event_type = event['detail']['eventName']
     
-    if event_type == 'CreateTags':
-        return handle_create_tags(event, context)
-    elif event_type == 'DeleteTags':
-        return handle_delete_tags(event, context)
+    if event_type in ['CreateTags', 'DeleteTags']:
+        vpc_id = event['detail']['requestParameters']['resourcesSet']['items'][0]['resourceId']
+        try:
+            # Events for the same VPC are processed one at a time, events for different VPCs concurrently
+            with resource_lock(vpc_id, context=context) as lease:
+                if lease.is_stale(event.get('time')):
+                    logger.info(f'Ignoring event older than the last one processed for {vpc_id}.')
+                    return {
+                        'statusCode': 200,
+                        'body': {
+                            'message': 'Stale event ignored.'
+                        }
+                    }
+                try:
+                    if event_type == 'CreateTags':
+                        return handle_create_tags(event, context, lease)
+                    return handle_delete_tags(event, context, lease)
+                finally:
+                    save_snapshot()
+        finally:
+            trace_pending_active_associations(context)
     
     return {
         'statusCode': 400,
         'body': {
             'message': json.dumps(f'Invalid event input.')
         }
-    }
\ No newline at end of file
+    }
+
+
+def trace_pending_active_associations(context):
+    """
+    Waits for the associations created by the invocation to be ACTIVE, to record it.
+    Runs after the lease is released, so events for the same resource don't wait
+    for it.
+    """
+    while pending_active_traces:
+        pending_active_traces.pop()(wait_seconds=active_wait_seconds(context))
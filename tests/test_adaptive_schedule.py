@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_code'))
+
+import adaptive_schedule
+from adaptive_schedule import Fingerprint, finish_run, next_interval_minutes, should_skip_run
+
+
+class StubSSM:
+    def __init__(self):
+        self.values = {}
+
+    def get_parameter(self, Name):
+        return {'Parameter': {'Value': self.values.get(Name, ' ')}}
+
+    def put_parameter(self, Name, Value, Overwrite):
+        self.values[Name] = Value
+
+
+class StubScheduler:
+    def __init__(self, expression, fail=False):
+        self.expression = expression
+        self.fail = fail
+        self.updates = []
+
+    def get_schedule(self, Name):
+        return {'Name': Name, 'ScheduleExpression': self.expression, 'State': 'ENABLED', 'Target': {}}
+
+    def update_schedule(self, **kwargs):
+        if self.fail:
+            raise Exception('UpdateSchedule failed')
+        self.updates.append(kwargs)
+        self.expression = kwargs['ScheduleExpression']
+
+
+class AdaptiveScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.ssm = StubSSM()
+        self.scheduler = StubScheduler('rate(5 minutes)')
+        clients = {'ssm': lambda: self.ssm, 'scheduler': lambda: self.scheduler}
+        patches = [
+            mock.patch.object(adaptive_schedule, 'aws_client', lambda service: clients[service]()),
+            mock.patch.object(adaptive_schedule, 'schedule_name', 'accept-shared-services'),
+            mock.patch.object(adaptive_schedule, 'schedule_state_parameter', 'state'),
+            mock.patch.object(adaptive_schedule, 'schedule_min_minutes', 5),
+            mock.patch.object(adaptive_schedule, 'schedule_max_minutes', 30),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def saved_state(self):
+        return json.loads(self.ssm.values['state'])
+
+    def test_next_interval(self):
+        self.assertEqual(next_interval_minutes(20, 3), 5)
+        self.assertEqual(next_interval_minutes(5, 0), 10)
+        self.assertEqual(next_interval_minutes(20, 0), 30)
+        self.assertEqual(next_interval_minutes(30, 0), 30)
+        # Intervals saved with other bounds are brought back within them
+        self.assertEqual(next_interval_minutes(1, 0), 5)
+
+    def test_fingerprint_ignores_order(self):
+        first, second = Fingerprint(), Fingerprint()
+        first.add('share-1', '2024-01-01')
+        first.add('share-2', '2024-01-01')
+        second.add('share-2', '2024-01-01')
+        second.add('share-1', '2024-01-01')
+        self.assertEqual(first.hexdigest(), second.hexdigest())
+
+    def test_fingerprint_changes_with_items(self):
+        first, second = Fingerprint(), Fingerprint()
+        first.add('share-1', '2024-01-01')
+        second.add('share-1', '2024-01-02')
+        self.assertNotEqual(first.hexdigest(), second.hexdigest())
+        second.add('share-2', None)
+        self.assertTrue(second.hexdigest().startswith('2-'))
+
+    def test_skip_only_unchanged_quiet_runs(self):
+        state = {'fingerprint': 'a', 'lastChanges': 0, 'lastFullRunAt': time.time() - 60}
+        self.assertTrue(should_skip_run(state, 'a'))
+        self.assertFalse(should_skip_run(state, 'b'))
+        self.assertFalse(should_skip_run(dict(state, lastChanges=2), 'a'))
+        self.assertFalse(should_skip_run(None, None))
+        self.assertFalse(should_skip_run({}, None))
+
+    def test_full_run_at_max_interval(self):
+        # The last full run ended a few seconds after the previous scheduled time
+        state = {'fingerprint': 'a', 'lastChanges': 0, 'lastFullRunAt': time.time() - 30 * 60 + 5}
+        self.assertFalse(should_skip_run(state, 'a'))
+
+    def test_finish_run_backs_off_and_updates_schedule(self):
+        finish_run({'intervalMinutes': 5}, 'a', 0)
+        self.assertEqual(self.scheduler.expression, 'rate(10 minutes)')
+        state = self.saved_state()
+        self.assertEqual(state['intervalMinutes'], 10)
+        self.assertEqual(state['fingerprint'], 'a')
+        self.assertEqual(state['lastChanges'], 0)
+
+    def test_finish_run_skipped_keeps_last_full_run(self):
+        finish_run({'intervalMinutes': 10, 'lastFullRunAt': 123, 'lastChanges': 0}, 'a', 0, skipped=True)
+        state = self.saved_state()
+        self.assertEqual(state['lastFullRunAt'], 123)
+        self.assertEqual(state['intervalMinutes'], 20)
+
+    def test_finish_run_fixes_schedule_out_of_sync(self):
+        # The state says 5 minutes, but a stack update put the schedule back to 1 minute
+        self.scheduler.expression = 'rate(1 minute)'
+        finish_run({'intervalMinutes': 5}, 'a', 4)
+        self.assertEqual(self.scheduler.expression, 'rate(5 minutes)')
+
+    def test_finish_run_does_not_update_matching_schedule(self):
+        finish_run({'intervalMinutes': 5}, 'a', 4)
+        self.assertEqual(self.scheduler.updates, [])
+        self.assertEqual(self.saved_state()['intervalMinutes'], 5)
+
+    def test_state_not_saved_when_schedule_update_fails(self):
+        self.scheduler.fail = True
+        with self.assertRaises(Exception):
+            finish_run({'intervalMinutes': 5}, 'a', 0)
+        self.assertNotIn('state', self.ssm.values)
+
+    def test_load_schedule_state_defaults(self):
+        state = adaptive_schedule.load_schedule_state()
+        self.assertEqual(state, {'intervalMinutes': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
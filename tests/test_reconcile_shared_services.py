@@ -0,0 +1,139 @@
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_code'))
+
+# The automations reconciled install boto3 and create clients when imported: the
+# reconciler is tested against stub listings instead
+accept = types.ModuleType('accept_shared_service')
+disassociate = types.ModuleType('disassociate_unshared_service')
+sys.modules.setdefault('accept_shared_service', accept)
+sys.modules.setdefault('disassociate_unshared_service', disassociate)
+
+import reconcile_shared_services as reconcile
+
+ALLOWED_ACCOUNT = '111111111111'
+OTHER_ACCOUNT = '222222222222'
+DEV_NETWORK = 'arn:aws:vpc-lattice:us-east-1:333333333333:servicenetwork/sn-dev'
+
+
+def share(name, arn, account=ALLOWED_ACCOUNT):
+    return {'name': name, 'resourceShareArn': arn, 'owningAccountId': account, 'tags': []}
+
+
+def service(name):
+    return f'arn:aws:vpc-lattice:us-east-1:{ALLOWED_ACCOUNT}:service/{name}'
+
+
+def association(service_name, network=DEV_NETWORK):
+    return {
+        'id': f'snsa-{service_name}',
+        'arn': f'{network}/snsa-{service_name}',
+        'serviceArn': service(service_name),
+        'serviceNetworkArn': network,
+        'status': 'ACTIVE'
+    }
+
+
+class ReconcileSharedServicesTest(unittest.TestCase):
+    def setUp(self):
+        # Shares of the allowed account named after an allowed stage, with their services
+        self.shares = [
+            share('dev', 'arn:share/dev'),
+            share('dev', 'arn:share/denied', account=OTHER_ACCOUNT),
+            share('prod', 'arn:share/prod'),
+        ]
+        self.share_services = {
+            'arn:share/dev': [service('new'), service('kept')],
+            'arn:share/denied': [service('denied')],
+            'arn:share/prod': [service('prod-only')],
+        }
+        self.associations = {DEV_NETWORK: [association('kept'), association('unshared')]}
+        self.shared_services = [service('new'), service('kept'), service('denied'), service('prod-only')]
+        self.created = []
+        self.deleted = []
+
+        attributes = {
+            accept: {
+                'stage_to_network_dict': {'dev': DEV_NETWORK},
+                'iter_accepted_resource_share_pages': lambda: iter([self.shares]),
+                'is_allowed_share': lambda s: s['owningAccountId'] == ALLOWED_ACCOUNT and s['name'] in ['dev', 'prod'],
+                'get_shared_services': lambda s: [{'arn': arn} for arn in self.share_services[s['resourceShareArn']]],
+                'create_association': lambda network, service_arn, *args: self.created.append((network, service_arn)),
+                'trace_active_associations': lambda *args: None,
+                'get_fingerprint': lambda: 'fingerprint',
+                'set_stage_to_network_dict': lambda: None,
+                'accept_pending_resource_share_invitations': lambda: 0,
+            },
+            disassociate: {
+                'iter_service_associations': lambda network: iter(self.associations.get(network, [])),
+                'iter_shared_services': lambda: iter({'arn': arn} for arn in self.shared_services),
+                'delete_association': lambda a: self.deleted.append(a['serviceArn']),
+            },
+        }
+        for module, values in attributes.items():
+            for name, value in values.items():
+                patch = mock.patch.object(module, name, value, create=True)
+                patch.start()
+                self.addCleanup(patch.stop)
+        for name in ['get_config', 'publish_decision_counters']:
+            patch = mock.patch.object(reconcile, name, lambda: None)
+            patch.start()
+            self.addCleanup(patch.stop)
+        patch = mock.patch.object(reconcile, 'load_schedule_state', lambda: None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def plan(self):
+        desired, existing, shared_service_arns = reconcile.take_snapshot({'dev': DEV_NETWORK})
+        adds, removes = reconcile.plan_changes(desired, existing, shared_service_arns)
+        return [service_arn for (_, service_arn), _ in adds], [a['serviceArn'] for a in removes]
+
+    def test_shared_service_not_associated_is_added(self):
+        adds, _ = self.plan()
+        self.assertIn(service('new'), adds)
+
+    def test_association_of_unshared_service_is_removed(self):
+        _, removes = self.plan()
+        self.assertEqual(removes, [service('unshared')])
+
+    def test_shared_and_associated_service_is_left_alone(self):
+        adds, removes = self.plan()
+        self.assertNotIn(service('kept'), adds)
+        self.assertNotIn(service('kept'), removes)
+
+    def test_share_not_allowlisted_is_ignored(self):
+        adds, _ = self.plan()
+        self.assertNotIn(service('denied'), adds)
+
+    def test_share_of_stage_without_service_network_is_ignored(self):
+        adds, _ = self.plan()
+        self.assertNotIn(service('prod-only'), adds)
+        self.assertEqual(adds, [service('new')])
+
+    def test_adds_and_removes_never_overlap(self):
+        # A share listing a service RAM no longer reports as shared (listings moved between calls)
+        self.shared_services.remove(service('new'))
+        self.shared_services.remove(service('kept'))
+        adds, removes = self.plan()
+        self.assertFalse(set(adds) & set(removes))
+        self.assertEqual(sorted(removes), [service('kept'), service('unshared')])
+
+    def test_apply_changes(self):
+        adds, removes = reconcile.plan_changes(*reconcile.take_snapshot({'dev': DEV_NETWORK}))
+        reconcile.apply_changes(adds, removes)
+        self.assertEqual(self.created, [(DEV_NETWORK, service('new'))])
+        self.assertEqual(self.deleted, [service('unshared')])
+
+    def test_lambda_handler(self):
+        response = reconcile.lambda_handler({}, None)
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(self.created, [(DEV_NETWORK, service('new'))])
+        self.assertEqual(self.deleted, [service('unshared')])
+
+
+if __name__ == '__main__':
+    unittest.main()
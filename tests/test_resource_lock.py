@@ -0,0 +1,107 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_code'))
+
+from resource_lock import InMemoryLockBackend, resource_lock
+
+
+class FakeContext:
+    def __init__(self, request_id, remaining_seconds):
+        self.aws_request_id = request_id
+        self.deadline = time.time() + remaining_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+class ResourceLockTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = InMemoryLockBackend()
+
+    def run_threads(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+    def test_same_key_is_serialized(self):
+        intervals = []
+
+        def handler():
+            with resource_lock('vpc-1', backend=self.backend, wait_seconds=5):
+                start = time.time()
+                time.sleep(0.2)
+                intervals.append((start, time.time()))
+
+        self.run_threads([handler] * 3)
+        intervals.sort()
+        self.assertEqual(len(intervals), 3)
+        for (_, end), (next_start, _) in zip(intervals, intervals[1:]):
+            self.assertLessEqual(end, next_start)
+
+    def test_different_keys_are_concurrent(self):
+        # Both handlers must hold their lease at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=2)
+        passed = []
+
+        def handler(key):
+            with resource_lock(key, backend=self.backend, wait_seconds=0):
+                barrier.wait()
+                passed.append(key)
+
+        self.run_threads([lambda: handler('vpc-1'), lambda: handler('vpc-2')])
+        self.assertEqual(sorted(passed), ['vpc-1', 'vpc-2'])
+
+    def test_wait_times_out_while_lease_is_held(self):
+        self.assertTrue(self.backend.acquire('vpc-1', 'other', 60))
+        with self.assertRaises(Exception):
+            with resource_lock('vpc-1', backend=self.backend, wait_seconds=0.3):
+                pass
+
+    def test_expired_lease_is_taken_over(self):
+        # The owner never releases the lease (e.g. its invocation timed out)
+        self.assertTrue(self.backend.acquire('vpc-1', 'crashed', 0.3))
+        with resource_lock('vpc-1', owner='next', backend=self.backend, wait_seconds=5) as lease:
+            self.assertEqual(lease.owner, 'next')
+        self.backend.release('vpc-1', 'crashed')
+        self.assertNotIn('leaseOwner', self.backend.items['vpc-1'])
+
+    def test_wait_leaves_work_time_of_the_invocation(self):
+        self.assertTrue(self.backend.acquire('vpc-1', 'other', 60))
+        start = time.time()
+        with self.assertRaises(Exception):
+            # 16 seconds left and 15 for the work (default): waits about 1 second, not 25
+            with resource_lock('vpc-1', backend=self.backend, context=FakeContext('r1', 16)):
+                pass
+        self.assertLess(time.time() - start, 5)
+
+    def test_lease_lasts_until_end_of_invocation(self):
+        with resource_lock('vpc-1', backend=self.backend, context=FakeContext('r1', 30)) as lease:
+            self.assertEqual(lease.owner, 'r1')
+            expires_in = self.backend.items['vpc-1']['leaseExpiresAt'] - time.time()
+            self.assertAlmostEqual(expires_in, 31, delta=1)
+
+    def test_state_is_kept_between_leases(self):
+        with resource_lock('vpc-1', backend=self.backend) as lease:
+            self.assertEqual(lease.state, {})
+            lease.save_state({'stage': 'dev', 'eventTime': '2024-01-01T00:00:10Z'})
+        with resource_lock('vpc-1', backend=self.backend) as lease:
+            self.assertEqual(lease.state['stage'], 'dev')
+
+    def test_is_stale(self):
+        with resource_lock('vpc-1', backend=self.backend) as lease:
+            self.assertFalse(lease.is_stale('2024-01-01T00:00:05Z'))
+            lease.save_state({'stage': 'dev', 'eventTime': '2024-01-01T00:00:10Z'})
+            self.assertTrue(lease.is_stale('2024-01-01T00:00:05Z'))
+            self.assertFalse(lease.is_stale('2024-01-01T00:00:10Z'))
+            self.assertFalse(lease.is_stale('2024-01-01T00:00:15Z'))
+            self.assertFalse(lease.is_stale(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
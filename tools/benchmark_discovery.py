@@ -0,0 +1,55 @@
+"""
+Compares the wall time of the synchronous and async discovery engines
+(lambda_code/discovery.py) against the fan-out width, using a local stub client
+that simulates the round trip of each VPC Lattice/RAM read.
+
+Usage:
+    python tools/benchmark_discovery.py [--latency 0.05] [--concurrency 10] [--widths 1,2,4,8,16,32,64]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_code'))
+
+from discovery import map_calls
+
+
+class StubLatticeClient:
+    """
+    Answers list_tags_for_resource after a fixed delay, like a remote API would.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+
+    def list_tags_for_resource(self, resourceArn):
+        time.sleep(self.latency)
+        return {'tags': {'stage': resourceArn.split('/')[-1]}}
+
+
+def measure(client, width, engine, concurrency):
+    arns = [f'arn:aws:vpc-lattice:us-east-1:111122223333:servicenetwork/sn-{i}' for i in range(width)]
+    start = time.perf_counter()
+    map_calls(lambda arn: client.list_tags_for_resource(resourceArn=arn), arns, engine, concurrency)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated seconds per request')
+    parser.add_argument('--concurrency', type=int, default=10, help='Async engine request budget')
+    parser.add_argument('--widths', default='1,2,4,8,16,32,64', help='Fan-out widths (requests per run)')
+    args = parser.parse_args()
+
+    client = StubLatticeClient(args.latency)
+    print(f'latency={args.latency}s concurrency={args.concurrency}')
+    print(f"{'width':>6}  {'sync':>8}  {'async':>8}  {'speedup':>7}")
+    for width in [int(w) for w in args.widths.split(',')]:
+        sync_time = measure(client, width, 'sync', args.concurrency)
+        async_time = measure(client, width, 'async', args.concurrency)
+        print(f'{width:>6}  {sync_time:>7.3f}s  {async_time:>7.3f}s  {sync_time / async_time:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Rebuilds per-resource timelines from the trace records emitted by the Lambda
+functions (see lambda_code/tracing.py) and reports the convergence latency - time
+from the `stage` tag change to each step - as p50/p95/p99 per stage and step.
+
+Usage:
+    aws logs filter-log-events --log-group-name <group> --filter-pattern '"convergence"' \\
+        --query 'events[].message' --output text > traces.log
+    python tools/convergence_report.py traces.log [more.log ...]
+
+Reads from stdin if no files are given. Records from several log groups (or Accounts)
+can be combined: they are joined by correlation ID, and records without one (e.g.
+accepted invitations) are attached through the RAM share ARN.
+"""
+import json
+import math
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+TRACE_MARKER = 'convergence'
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def parse_records(lines):
+    for line in lines:
+        start = line.find('{')
+        if start < 0 or TRACE_MARKER not in line:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        if record.get('trace') == TRACE_MARKER:
+            yield record
+
+
+def build_timelines(records):
+    """
+    Returns {(correlation_id, resource): [records sorted by time]}.
+    """
+    records = list(records)
+    share_to_correlation = {}
+    for r in records:
+        if r.get('correlationId') and r.get('share'):
+            share_to_correlation[r['share']] = (r['correlationId'], r.get('origin'), r.get('resource'))
+
+    timelines = defaultdict(list)
+    for r in records:
+        correlation_id = r.get('correlationId')
+        if not correlation_id and r.get('share') in share_to_correlation:
+            correlation_id, origin, resource = share_to_correlation[r['share']]
+            r = dict(r, correlationId=correlation_id, origin=origin, resource=r.get('resource') or resource)
+        if not correlation_id or not r.get('origin'):
+            continue
+        timelines[(correlation_id, r.get('resource'))].append(r)
+
+    for timeline in timelines.values():
+        timeline.sort(key=lambda r: r['ts'])
+    return timelines
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile.
+    """
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def step_latencies(timelines):
+    """
+    Seconds from the tag change to the first occurrence of each step, plus the
+    `converged` pseudo-step: the first record of the timeline reporting ACTIVE.
+    Keyed by (stage, step).
+    """
+    latencies = defaultdict(list)
+    incomplete = 0
+    for timeline in timelines.values():
+        origin = parse_time(timeline[0]['origin'])
+        stage = next((r['stage'] for r in timeline if r.get('stage')), '-')
+        seen = set()
+        converged = False
+        for r in timeline:
+            elapsed = parse_time(r['ts']) - origin
+            if r['step'] not in seen:
+                seen.add(r['step'])
+                latencies[(stage, r['step'])].append(elapsed)
+            if not converged and r.get('status') == 'ACTIVE':
+                converged = True
+                latencies[(stage, 'converged')].append(elapsed)
+        if not converged:
+            incomplete += 1
+    return latencies, incomplete
+
+
+def report(latencies, incomplete, total):
+    rows = [('stage', 'step', 'count', 'p50', 'p95', 'p99')]
+    for (stage, step), values in sorted(latencies.items(), key=lambda kv: (kv[0][0], percentile(kv[1], 50))):
+        rows.append((
+            stage,
+            step,
+            str(len(values)),
+            *(f'{percentile(values, p):.1f}s' for p in (50, 95, 99))
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows]
+    lines.append(f'{total} timelines, {incomplete} without an ACTIVE association')
+    return '\n'.join(lines)
+
+
+def main(paths):
+    if paths:
+        lines = []
+        for path in paths:
+            with open(path) as f:
+                lines.extend(f)
+    else:
+        lines = sys.stdin
+    timelines = build_timelines(parse_records(lines))
+    latencies, incomplete = step_latencies(timelines)
+    print(report(latencies, incomplete, len(timelines)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])